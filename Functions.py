@@ -25,7 +25,7 @@
 ## 1: Var_bounds(Data,B,B_dat,theta,P,lamb,confidence = 0.95)
 ## 2: Smoothing_cost(lamb,Data,B,q,c,choice)
 ## 3: Smoothing_par(Data,B,q,c,lamb,choice)
-## 4: full_search_nk(Data,p,q)
+## 4: full_search_nk(Data,p,q,n_range = None,lamb = 0.1)
 
 ## Mixed Model Formulation with model fitting through Restricted Maximum Likelihood
 ## 1: REML(par,Data,X,Z,sigma)
@@ -38,13 +38,76 @@
 ## 1: Polynomials_fit(Data,points)
 ## 2: Outlier(Data,thresh1,thresh2)
 
+#### Two dimensional P-splines on gridded data (array arithmetic, no Kronecker product bases)
+## 1: Rowtensor(X1,X2)
+## 2: Gram_2D(B1,B2,W)
+## 3: Penalty_2D(P1,P2,lamb)
+## 4: Fit_2D(Y,W,B1,B2,P1,P2,lamb)
+## 5: Smoothing_cost_2D(lamb,Y,W,B1,B2,P1,P2)
+## 6: Smoothing_par_2D(Y,W,B1,B2,P1,P2,lamb)
+## 7: Pspline_2D(x1,x2,Y,p,n,q,W = None,lamb = (0.1,0.1))
+
+#### Residual bootstrap confidence bands
+## 1: Bootstrap_solve(factor,BtY)
+## 2: Bootstrap_bounds(Data,B,B_dat,theta,P,lamb,B_derv = None,nboot = 500,confidence = 0.95,processes = None,seed = None)
+
+#### Fast path for uniform knots (basis functions are shifted copies of one template)
+## 1: Is_uniform(x,tol = 1.0e-8)
+## 2: Template_uniform(p)
+## 3: Local_basis_uniform(n,p,U,loc,derv = 0)
+## 4: Basis_Pspline_uniform(n,p,U,loc,derv = 0)
+## 5: Gram_Pspline_uniform(n,p,U,loc,y)
+
+#### Cyclic P-splines for periodic data (circulant penalty, FFT solves)
+## 1: Knot_pspline_periodic(Data,p,n,period = None)
+## 2: Basis_Pspline_periodic(n,p,U,loc,derv = 0)
+## 3: Local_basis_periodic(n,p,U,loc,derv = 0)
+## 4: Penalty_p_periodic(q,c)
+## 5: Smoothing_cost_circulant(lamb,yy,bh,g,s,m)
+## 6: Smoothing_cost_gram(lamb,yy,b,G,P,m)
+## 7: Pspline_periodic(Data,p,n,q,period = None,lamb = 0.1)
+
+#### Persistent hyperparameter cache
+## 1: Hyper_cache(path,max_entries = 100000,head = 16,timeout = 60.0)
+## 2: Cached_search_nk(Data,p,q,cache,method = 'GCV',width = 2,max_change = 0.1,max_chain = 3)
+
+#### State-space engine (one coefficient per data point), O(N q^2) alternative to the dense REML path
+## 1: Band_ss(q,N,lamb)
+## 2: Smoother_ss(Data,q,lamb)
+## 3: Band_inverse_diag(L)
+## 4: Deviance_ss(Data,q,lamb)
+## 5: REML_ss(par,Data,q)
+## 6: max_reml_ss(Data,q)
+## 7: Inference_ss(Data,q,lamb,sig,confidence = 0.95)
+
+#### Exact roots, extrema and inflection points from the coefficients
+## 1: Pspline_ppoly(theta,p,U,n,k = 0)
+## 2: Roots_Pspline(theta,p,U,n,k = 0,value = 0.0)
+## 3: Flat_spans_Pspline(theta,p,U,n,k = 0,value = 0.0)
+## 4: Turning_points(theta,p,U,n,k)
+## 5: Extrema_Pspline(theta,p,U,n)
+## 6: Inflection_Pspline(theta,p,U,n)
+
+#### Exact integrals and interval aggregates
+## 1: Integral_Pspline(theta,p,U,a,b)
+## 2: Interval_mean(theta,p,U,a,b)
+## 3: Integral_weights(p,U,a,b)
+## 4: Integral_var(Data,B_dat,theta,P,lamb,p,U,a,b)
+
 #############################################################################################################################
 
 from numpy import *
 import pandas as pd
 from numpy.linalg import inv,det
-from scipy.optimize import minimize
+from scipy.optimize import minimize,minimize_scalar
 import scipy.stats
+import scipy.linalg
+import scipy.interpolate
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import sqlite3
+import time
+from contextlib import closing
 
 ########################### ########################### ########################### 
 ########################### GENERAL FUNCTIONS ####################################  
@@ -542,12 +605,14 @@ def Smoothing_par(Data,B,q,c,lamb,choice):
     
     
 
-def full_search_nk(Data,p,q):
+def full_search_nk(Data,p,q,n_range = None,lamb = 0.1):
     ## Objective: Compute Optimal number of sections for given data and corresponding optimal lambda
     ## Input
     ## 1: Data: dataset with dimensions: number of points x 2
     ## 2: p: degree of bases
     ## 3: q: order of penalty
+    ## 4: n_range: [first, last] number of sections to search; defaults to all of them
+    ## 5: lamb: Initialization for lambda
     
     ## Output
     ## 1. Opt_n: Optimal number of sections
@@ -556,16 +621,19 @@ def full_search_nk(Data,p,q):
     
     
     n = 1 ## number of sections on the curve
+    n_last = Data.shape[0]-1
+    if n_range is not None:
+        n = n_range[0] if n_range[0] > 1 else 1
+        n_last = n_range[1] if n_range[1] < n_last else n_last
     inc = 1
     fact = 1
     choice = 2  ### always using GCV for now
     comp = 1.0e+9
     #while n<Data.shape[0]-p-1:
-    while n<Data.shape[0]:
+    while n<=n_last:
         c = n+p
         U = Kno_pspline_opt(Data,p,n)
         B = Basis_Pspline(n,p,U,Data[:,0])
-        lamb = 0.1
         lam = Smoothing_par(Data,B,q,c,lamb,choice)
         #print(lam.x[0],lam.fun)
         if lam.fun<comp:
@@ -852,6 +920,1142 @@ def Outlier(Data,thresh1,thresh2):
     return (Dataa,point)
 
 
+###########################################################################################################################
+### Two dimensional P-splines on gridded data (GLAM)
+###########################################################################################################################
+
+def Rowtensor(X1,X2):
+    ## Objective: Compute the row tensor of two matrices with the same number of rows
+    ## Input
+    ## 1: X1: matrix with dimensions: m x c1
+    ## 2: X2: matrix with dimensions: m x c2
+    
+    ## Output
+    ## 1: G: row tensor with dimensions m x c1*c2, G[i,j*c2+k] = X1[i,j]*X2[i,k]
+    
+    G = (X1[:,:,newaxis]*X2[:,newaxis,:]).reshape(X1.shape[0],-1)
+    return G
+
+
+def Gram_2D(B1,B2,W):
+    ## Objective: Compute the inner product matrix B'WB of the tensor product bases without forming the Kronecker product
+    ## Input
+    ## 1: B1: Bases matrix along the first axis (m1 x c1)
+    ## 2: B2: Bases matrix along the second axis (m2 x c2)
+    ## 3: W: weights on the grid (m1 x m2), zero for missing cells
+    
+    ## Output
+    ## 1: BWB: matrix with dimensions c1*c2 x c1*c2 (coefficients ordered row-wise, theta[j*c2+k] = Theta[j,k])
+    
+    c1 = B1.shape[1]
+    c2 = B2.shape[1]
+    M = Rowtensor(B1,B1).T.dot(W).dot(Rowtensor(B2,B2))
+    BWB = M.reshape(c1,c1,c2,c2).transpose(0,2,1,3).reshape(c1*c2,c1*c2)
+    return BWB
+
+
+def Penalty_2D(P1,P2,lamb):
+    ## Objective: Compute the combined penalty matrix with separate smoothing parameters per axis
+    ## Input
+    ## 1: P1: Penalty matrix along the first axis (c1 x c1)
+    ## 2: P2: Penalty matrix along the second axis (c2 x c2)
+    ## 3: lamb: [lambda along first axis, lambda along second axis]
+    
+    ## Output
+    ## 1: P: Penalty matrix with dimensions c1*c2 x c1*c2
+    
+    P = lamb[0]*kron(P1,eye(P2.shape[0])) + lamb[1]*kron(eye(P1.shape[0]),P2)
+    return P
+
+
+def Fit_2D(Y,W,B1,B2,P1,P2,lamb):
+    ## Objective: Compute the coefficients of the tensor product P-spline and the effective dimension
+    ## Input
+    ## 1: Y: gridded observations (m1 x m2)
+    ## 2: W: weights on the grid (m1 x m2), zero for missing cells
+    ## 3: B1, B2: Bases matrices along the two axes
+    ## 4: P1, P2: Penalty matrices along the two axes
+    ## 5: lamb: [lambda along first axis, lambda along second axis]
+    
+    ## Output
+    ## 1: Theta: coefficient matrix (c1 x c2)
+    ## 2: ed: effective dimension (trace of the hat matrix)
+    
+    BWB = Gram_2D(B1,B2,W)
+    BWy = B1.T.dot(W*Y).dot(B2).reshape(-1,1)
+    A = BWB + Penalty_2D(P1,P2,lamb)
+    sol = linalg.solve(A,hstack([BWy,BWB]))
+    Theta = sol[:,0].reshape(B1.shape[1],B2.shape[1])
+    ed = trace(sol[:,1:])
+    return (Theta,ed)
+
+
+def Smoothing_cost_2D(lamb,Y,W,B1,B2,P1,P2):
+    ## Objective: Compute the Generalized Cross Validation cost of the tensor product P-spline
+    ## Input
+    ## 1: lamb: [lambda along first axis, lambda along second axis]
+    ## 2: Y: gridded observations (m1 x m2)
+    ## 3: W: weights on the grid (m1 x m2), zero for missing cells
+    ## 4: B1, B2: Bases matrices along the two axes
+    ## 5: P1, P2: Penalty matrices along the two axes
+    
+    ## Output
+    ## 1: obj: Computed metric value
+    
+    Theta,ed = Fit_2D(Y,W,B1,B2,P1,P2,lamb)
+    r = Y - B1.dot(Theta).dot(B2.T)
+    n = sum(W)
+    obj = sum(W*r**2)/(1-ed/n)**2
+    return obj
+
+
+def Smoothing_par_2D(Y,W,B1,B2,P1,P2,lamb):
+    ## Objective: Compute the optimized values of the two smoothing parameters
+    ## Input
+    ## 1: Y: gridded observations (m1 x m2)
+    ## 2: W: weights on the grid (m1 x m2), zero for missing cells
+    ## 3: B1, B2: Bases matrices along the two axes
+    ## 4: P1, P2: Penalty matrices along the two axes
+    ## 5: lamb: Initialization for [lambda along first axis, lambda along second axis]
+    
+    ## Output
+    ## 1: Optimal parameter (containing information for optimized cost and corresponding parameters)
+    
+    args = (Y,W,B1,B2,P1,P2)
+    bnds = [(1.0e-2, None),(1.0e-2, None)]
+    lam = minimize(Smoothing_cost_2D,lamb,args,bounds=bnds,method='SLSQP')
+    return lam
+
+
+def Pspline_2D(x1,x2,Y,p,n,q,W = None,lamb = (0.1,0.1)):
+    ## Objective: Fit a tensor product P-spline to gridded data with GCV selected smoothing parameters
+    ## Input
+    ## 1: x1: locations along the first axis (m1,)
+    ## 2: x2: locations along the second axis (m2,)
+    ## 3: Y: gridded observations (m1 x m2)
+    ## 4: p: degree of bases
+    ## 5: n: [number of sections along first axis, number of sections along second axis]
+    ## 6: q: order of penalty
+    ## 7: W: weights on the grid (m1 x m2), zero for missing cells; defaults to all ones
+    ## 8: lamb: Initialization for the two lambdas
+    
+    ## Output
+    ## 1: Theta: coefficient matrix (c1 x c2), the surface at new locations is B1pred.dot(Theta).dot(B2pred.T)
+    ## 2: U1, U2: Knot vectors along the two axes
+    ## 3: opt_lam: optimal [lambda along first axis, lambda along second axis]
+    ## 4: sigmasq: Fitting Variance
+    
+    if W is None:
+        W = ones(Y.shape)
+    Y = where(W>0,Y,0)
+    
+    U1 = Knot_pspline(x1.reshape(-1,1),p,n[0])
+    U2 = Knot_pspline(x2.reshape(-1,1),p,n[1])
+    B1 = Basis_Pspline(n[0],p,U1,x1)
+    B2 = Basis_Pspline(n[1],p,U2,x2)
+    P1 = Penalty_p(q,n[0]+p)
+    P2 = Penalty_p(q,n[1]+p)
+    
+    lam = Smoothing_par_2D(Y,W,B1,B2,P1,P2,lamb)
+    opt_lam = lam.x
+    
+    ## Computing sig
+    Theta,ed = Fit_2D(Y,W,B1,B2,P1,P2,opt_lam)
+    r = Y - B1.dot(Theta).dot(B2.T)
+    sigmasq = sum(W*r**2)/(sum(W)-ed)
+    return [Theta,U1,U2,opt_lam,sigmasq]
+
+
+###########################################################################################################################
+### Residual bootstrap confidence bands
+###########################################################################################################################
+
+def Bootstrap_solve(factor,BtY):
+    ## Objective: Solve the penalized normal equations for a block of right hand sides with a cached Cholesky factor
+    ## Input
+    ## 1: factor: Cholesky factor of B'B + lamb*P (output of scipy.linalg.cho_factor)
+    ## 2: BtY: right hand sides, one column per bootstrap replicate
+    
+    ## Output
+    ## 1: Theta: coefficients, one column per bootstrap replicate
+    
+    return scipy.linalg.cho_solve(factor,BtY)
+
+
+def Bootstrap_bounds(Data,B,B_dat,theta,P,lamb,B_derv = None,nboot = 500,confidence = 0.95,processes = None,seed = None):
+    ## Objective: Compute percentile confidence bands by residual bootstrap with knots, bases and lambda kept fixed
+    ## Input:
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: B: bases matrix for prediction
+    ## 3: B_dat: bases matrix at data locations
+    ## 4: theta: coordinate of projection on the bases
+    ## 5: P: Penalty matrix
+    ## 6: lamb: Optimal lambda computed
+    ## 7: B_derv: derivative bases matrix for prediction (optional, output of Basis_derv_Pspline)
+    ## 8: nboot: number of bootstrap replicates
+    ## 9: confidence: defaults to 95% if no value provided
+    ## 10: processes: number of worker processes for the solves, None solves in this process
+    ## 11: seed: seed for the resampling
+    
+    ## Output
+    ## 1: lower, upper: percentile band of the prediction
+    ## 2: lower_d, upper_d: percentile band of the derivative (None if B_derv is not provided)
+    
+    P = lamb*P
+    n = Data.shape[0]
+    y = Data[:,1].reshape(-1,1)
+    fit = B_dat.dot(theta.reshape(-1,1))
+    nr = (y - fit).flatten()
+    
+    ## The factorization is done once and shared by all replicates
+    factor = scipy.linalg.cho_factor(B_dat.T.dot(B_dat) + P)
+    term = B_dat.dot(scipy.linalg.cho_solve(factor,B_dat.T))
+    df_res = n - 2*trace(term) + trace(term.dot(term.T))
+    
+    ## Centered residuals inflated to account for the degrees of freedom used by the fit
+    r = (nr - mean(nr))*sqrt(n/df_res)
+    rng = random.default_rng(seed)
+    Ystar = fit + r[rng.integers(0,n,size = (n,nboot))]
+    BtY = B_dat.T.dot(Ystar)
+    
+    if processes is None or processes <= 1:
+        Theta = Bootstrap_solve(factor,BtY)
+    else:
+        blocks = array_split(BtY,processes,axis = 1)
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            Theta = hstack(list(pool.map(Bootstrap_solve,[factor]*len(blocks),blocks)))
+    
+    alpha = 100*(1-confidence)/2.
+    F = B.dot(Theta)
+    lower = percentile(F,alpha,axis = 1)
+    upper = percentile(F,100-alpha,axis = 1)
+    
+    lower_d = None
+    upper_d = None
+    if B_derv is not None:
+        F_d = B_derv.dot(Theta)
+        lower_d = percentile(F_d,alpha,axis = 1)
+        upper_d = percentile(F_d,100-alpha,axis = 1)
+    return(lower,upper,lower_d,upper_d)
+
+
+###########################################################################################################################
+### Fast path for uniform knots
+###########################################################################################################################
+
+def Is_uniform(x,tol = 1.0e-8):
+    ## Objective: Check whether the points are equally spaced
+    ## Input
+    ## 1: x: sorted locations (or knot vector)
+    ## 2: tol: tolerance relative to the spacing
+    
+    ## Output
+    ## 1: True if all consecutive differences are equal within the tolerance
+    
+    x = asarray(x,dtype = float).flatten()
+    if len(x) < 3:
+        return True
+    d = diff(x)
+    return bool(d[0] > 0 and abs(d-d[0]).max() <= tol*d[0])
+
+
+def Template_uniform(p):
+    ## Objective: Compute the polynomial pieces shared by all basis functions on uniform knots
+    ## Input
+    ## 1: p: degree
+    
+    ## Output
+    ## 1: M: matrix (p+1 x p+1), row a holds the power coefficients in the local coordinate x (0<=x<1) of the 
+    ##       a-th non-zero basis function on a knot span (a = 0 is the leftmost one)
+    
+    ## On uniform knots every basis function is a shifted copy of one template, so one span of 
+    ## integer knots is enough to get the pieces
+    U0 = arange(2*p+2,dtype = float)
+    x = (arange(p+1)+0.5)/(p+1)
+    V = zeros([p+1,p+1])
+    for a in range(p+1):
+        for k in range(p+1):
+            V[k,a] = Bspline_Basis(p,a,p+x[k],U0)
+    M = linalg.solve(vander(x,p+1,increasing = True),V).T
+    return M
+
+
+def Local_basis_uniform(n,p,U,loc,derv = 0):
+    ## Objective: Compute the p+1 non-zero basis function values (or first derivatives) at each location on uniform knots
+    ## Input
+    ## 1: n: number of sections on the curve
+    ## 2: p: degree
+    ## 3: U: uniform Knot vector (output of Knot_pspline)
+    ## 4: loc: the locations at which we want basis functions to be evaluated
+    ## 5: derv: 0 for the basis functions, 1 for their first derivatives
+    
+    ## Output
+    ## 1: cols: column index of each value (num x p+1)
+    ## 2: V: basis function values (num x p+1), zero where the column falls outside the bases
+    
+    c = n+p
+    h = U[1]-U[0]
+    loc = asarray(loc,dtype = float).flatten()
+    t = (loc-U[0])/h
+    j = clip(floor(t),0,len(U)-2).astype(int)
+    x = t-j
+    
+    M = Template_uniform(p)
+    if derv == 1:
+        M = M[:,1:]*arange(1,p+1)/h
+    V = vander(x,M.shape[1],increasing = True).dot(M.T)
+    
+    cols = (j-p)[:,newaxis] + arange(p+1)
+    out = (cols < 0) | (cols >= c) | ((t < 0) | (t >= len(U)-1))[:,newaxis]
+    V[out] = 0
+    cols = clip(cols,0,c-1)
+    return (cols,V)
+
+
+def Basis_Pspline_uniform(n,p,U,loc,derv = 0):
+    ## Objective: Compute the Bases matrix (or derivative bases matrix) by tiling the uniform knot template
+    ##            Falls back to Basis_Pspline / Basis_derv_Pspline when the knots are not uniform
+    ## Input
+    ## 1: n: number of sections on the curve
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: loc: the locations at which we want basis functions to be evaluated
+    ## 5: derv: 0 for the basis functions, 1 for their first derivatives
+    
+    ## Output
+    ## 1: B: bases matrix
+    
+    if not Is_uniform(U):
+        if derv == 1:
+            return Basis_derv_Pspline(n,p,U,loc)
+        return Basis_Pspline(n,p,U,loc)
+    
+    c = n+p
+    cols,V = Local_basis_uniform(n,p,U,loc,derv)
+    num = cols.shape[0]
+    rows = arange(num)[:,newaxis]
+    B = bincount((rows*c+cols).flatten(),V.flatten(),minlength = num*c).reshape(num,c)
+    return B
+
+
+def Gram_Pspline_uniform(n,p,U,loc,y):
+    ## Objective: Assemble the normal equations B'B and B'y directly from the local basis values, without forming B
+    ## Input
+    ## 1: n: number of sections on the curve
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: loc: data locations
+    ## 5: y: observations at the data locations
+    
+    ## Output
+    ## 1: BtB: matrix (c x c), banded with bandwidth p
+    ## 2: Bty: vector (c x 1)
+    
+    if not Is_uniform(U):
+        B = Basis_Pspline(n,p,U,loc)
+        return (B.T.dot(B),B.T.dot(asarray(y).reshape(-1,1)))
+    
+    c = n+p
+    cols,V = Local_basis_uniform(n,p,U,loc)
+    y = asarray(y,dtype = float).flatten()
+    idx = (cols[:,:,newaxis]*c + cols[:,newaxis,:]).flatten()
+    BtB = bincount(idx,(V[:,:,newaxis]*V[:,newaxis,:]).flatten(),minlength = c*c).reshape(c,c)
+    Bty = bincount(cols.flatten(),(V*y[:,newaxis]).flatten(),minlength = c).reshape(-1,1)
+    return (BtB,Bty)
+
+
+###########################################################################################################################
+### Cyclic P-splines for periodic (seasonal) data
+###########################################################################################################################
+
+def Knot_pspline_periodic(Data,p,n,period = None):
+    ## Objective: Compute the equidistant knot vector covering one period
+    ## Input:
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: p: degree
+    ## 3: n: number of sections on one period
+    ## 4: period: length of the period; defaults to the data span plus one sampling step (equally spaced data)
+    
+    ## Output:
+    ## 1: U: Knot vector, one period is [U[p],U[n+p])
+    
+    m = Data.shape[0]
+    if period is None:
+        period = (Data[-1,0] - Data[0,0])*m/(m-1)
+    U = Knot_pspline(array([[Data[0,0]],[Data[0,0]+period]]),p,n)
+    return U
+
+
+def Basis_Pspline_periodic(n,p,U,loc,derv = 0):
+    ## Objective: Compute the wrapped Bases matrix (or its first derivative) at given locations
+    ## Input
+    ## 1: n: number of sections on one period (also the number of basis functions)
+    ## 2: p: degree
+    ## 3: U: Knot vector (output of Knot_pspline_periodic)
+    ## 4: loc: the locations at which we want basis functions to be evaluated, any period
+    ## 5: derv: 0 for the basis functions, 1 for their first derivatives
+    
+    ## Output
+    ## 1: B: bases matrix with dimensions num x n
+    
+    cols,V = Local_basis_periodic(n,p,U,loc,derv)
+    num = cols.shape[0]
+    rows = arange(num)[:,newaxis]
+    B = bincount((rows*n+cols).flatten(),V.flatten(),minlength = num*n).reshape(num,n)
+    return B
+
+
+def Local_basis_periodic(n,p,U,loc,derv = 0):
+    ## Objective: Compute the non-zero wrapped basis function values at each location
+    ## Input
+    ## 1: n: number of sections on one period
+    ## 2: p: degree
+    ## 3: U: Knot vector (output of Knot_pspline_periodic)
+    ## 4: loc: the locations at which we want basis functions to be evaluated
+    ## 5: derv: 0 for the basis functions, 1 for their first derivatives
+    
+    ## Output
+    ## 1: cols: column index of each value (num x p+1)
+    ## 2: V: basis function values (num x p+1)
+    
+    period = U[n+p]-U[p]
+    loc = U[p] + mod(asarray(loc,dtype = float).flatten()-U[p],period)
+    cols,V = Local_basis_uniform(n,p,U,loc,derv)
+    
+    ## Basis functions running past the end of the period continue from the start
+    return (cols % n,V)
+
+
+def Penalty_p_periodic(q,c):
+    ## Objective: Compute the circulant Penalty matrix (differences wrap around the period)
+    ## Input
+    ## 1: q: It is the order of difference which is being considered
+    ## 2: c: This is the number of basis vectors under consideration
+    
+    ## Output
+    ## 1: Penalty matrix P
+    
+    coef = diff(eye(q+1),q,axis = 0).flatten()
+    D = zeros([c,c])
+    for i in range(c):
+        for k in range(q+1):
+            D[i,(i+k) % c] += coef[k]
+    P = D.T.dot(D)
+    return P
+
+
+def Smoothing_cost_circulant(lamb,yy,bh,g,s,m):
+    ## Objective: Compute the Generalized Cross Validation cost when B'B and P are circulant, in O(c)
+    ## Input
+    ## 1: lamb: Value of the smoothing parameter lambda
+    ## 2: yy: y'y
+    ## 3: bh: FFT of B'y
+    ## 4: g: eigenvalues of B'B (FFT of its first column)
+    ## 5: s: eigenvalues of the circulant penalty
+    ## 6: m: number of data points
+    
+    ## Output
+    ## 1: obj: Computed metric value
+    
+    lamb = asarray(lamb).flatten()[0]
+    c = len(g)
+    th = bh/(g+lamb*s)
+    rss = yy - 2*real(sum(conj(bh)*th))/c + sum(g*abs(th)**2)/c
+    ed = sum(g/(g+lamb*s))
+    obj = rss/(1-ed/m)**2
+    return obj
+
+
+def Smoothing_cost_gram(lamb,yy,b,G,P,m):
+    ## Objective: Compute the Generalized Cross Validation cost from the normal equations
+    ## Input
+    ## 1: lamb: Value of the smoothing parameter lambda
+    ## 2: yy: y'y
+    ## 3: b: B'y
+    ## 4: G: B'B
+    ## 5: P: Penalty matrix
+    ## 6: m: number of data points
+    
+    ## Output
+    ## 1: obj: Computed metric value
+    
+    lamb = asarray(lamb).flatten()[0]
+    sol = linalg.solve(G + lamb*P,hstack([b,G]))
+    th = sol[:,:1]
+    rss = yy - 2*th.T.dot(b)[0][0] + th.T.dot(G).dot(th)[0][0]
+    ed = trace(sol[:,1:])
+    obj = rss/(1-ed/m)**2
+    return obj
+
+
+def Pspline_periodic(Data,p,n,q,period = None,lamb = 0.1):
+    ## Objective: Fit a cyclic P-spline with GCV selected lambda
+    ##            For equally spaced data with a whole number of points per section, B'B and P are circulant 
+    ##            and the solves and GCV are done with FFTs; otherwise the normal equations are solved directly
+    ## Input
+    ## 1: Data: dataset with dimensions: number of points x 2, one period of observations
+    ## 2: p: degree of bases
+    ## 3: n: number of sections on one period (also the number of basis functions)
+    ## 4: q: order of penalty
+    ## 5: period: length of the period; defaults to the data span plus one sampling step
+    ## 6: lamb: Initialization for lambda
+    
+    ## Output
+    ## 1: theta: coordinate of projection on the bases, predictions are Basis_Pspline_periodic(n,p,U,loc).dot(theta)
+    ## 2: U: Knot vector
+    ## 3: opt_lam: optimal lambda
+    ## 4: sigmasq: Fitting Variance
+    
+    m = Data.shape[0]
+    x = Data[:,0]
+    y = Data[:,1]
+    U = Knot_pspline_periodic(Data,p,n,period)
+    period = U[n+p]-U[p]
+    yy = y.dot(y)
+    cols,V = Local_basis_periodic(n,p,U,x)
+    b = bincount(cols.flatten(),(V*y[:,newaxis]).flatten(),minlength = n)
+    bnds = [(1.0e-2, None)]
+    
+    step = period/m
+    circulant = m % n == 0 and Is_uniform(x) and abs(x[1]-x[0]-step) <= 1.0e-8*step and abs(x[0]-U[p]) <= 1.0e-8*step
+    if circulant:
+        ## First column of B'B; the whole matrix is circulant so it is diagonalized by the FFT
+        v0 = sum(V*(cols == 0),axis = 1)
+        g = real(fft.fft(bincount(cols.flatten(),(V*v0[:,newaxis]).flatten(),minlength = n)))
+        s = (2-2*cos(2*pi*arange(n)/n))**q
+        bh = fft.fft(b)
+        
+        lam = minimize(Smoothing_cost_circulant,[lamb],(yy,bh,g,s,m),bounds = bnds,method = 'SLSQP')
+        opt_lam = lam.x[0]
+        h = g/(g+opt_lam*s)
+        theta = real(fft.ifft(bh/(g+opt_lam*s))).reshape(-1,1)
+        df_res = m - 2*sum(h) + sum(h**2)
+    else:
+        G = bincount((cols[:,:,newaxis]*n + cols[:,newaxis,:]).flatten(),(V[:,:,newaxis]*V[:,newaxis,:]).flatten(),minlength = n*n).reshape(n,n)
+        P = Penalty_p_periodic(q,n)
+        lam = minimize(Smoothing_cost_gram,[lamb],(yy,b.reshape(-1,1),G,P,m),bounds = bnds,method = 'SLSQP')
+        opt_lam = lam.x[0]
+        Ainv = inv(G + opt_lam*P)
+        theta = Ainv.dot(b.reshape(-1,1))
+        H = Ainv.dot(G)
+        df_res = m - 2*trace(H) + trace(H.dot(H))
+    
+    ## Computing sig
+    nr = y - sum(V*theta.flatten()[cols],axis = 1)
+    sigmasq = nr.dot(nr)/df_res
+    return [theta,U,opt_lam,sigmasq]
+
+
+###########################################################################################################################
+### Persistent hyperparameter cache for full_search_nk
+###########################################################################################################################
+
+class Hyper_cache:
+    ## Objective: On-disk store of full_search_nk results (opt_n, opt_lam, sigmasq) keyed by a fingerprint of the 
+    ##            data and (p, q, method); a single sqlite file can be shared by several worker processes
+    ##            Each entry also records chain: 0 if it came from a full search, k if it came from k narrowed 
+    ##            searches in a row since the last full one
+    ## Input:
+    ## 1: path: location of the cache file
+    ## 2: max_entries: number of entries kept, the least recently used ones are evicted beyond this
+    ## 3: head: number of leading points identifying a series, used to find earlier (shorter) versions of it
+    ## 4: timeout: seconds a worker waits for another one holding the lock
+    
+    def __init__(self,path,max_entries = 100000,head = 16,timeout = 60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.head = head
+        self.timeout = timeout
+        with closing(self.connect()) as con:
+            with con:
+                con.execute('PRAGMA journal_mode=WAL')
+                con.execute('CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, head TEXT, npts INTEGER, '
+                            'opt_n INTEGER, opt_lam REAL, sigmasq REAL, last_used REAL, chain INTEGER DEFAULT 0)')
+                ## Files written before chain was recorded
+                if 'chain' not in [r[1] for r in con.execute('PRAGMA table_info(search)')]:
+                    con.execute('ALTER TABLE search ADD COLUMN chain INTEGER DEFAULT 0')
+                con.execute('CREATE INDEX IF NOT EXISTS search_head ON search (head, npts)')
+                con.execute('CREATE INDEX IF NOT EXISTS search_used ON search (last_used)')
+    
+    def connect(self):
+        return sqlite3.connect(self.path,timeout = self.timeout)
+    
+    def fingerprint(self,Data,p,q,method):
+        ## Objective: Hash of the data values together with the search settings
+        h = hashlib.sha1(ascontiguousarray(Data,dtype = float64).tobytes())
+        h.update(('%d,%d,%s,%d' % (p,q,method,Data.shape[0])).encode())
+        return h.hexdigest()
+    
+    def get(self,Data,p,q,method = 'GCV'):
+        ## Objective: Return the cached [opt_n,opt_lam,sigmasq] for exactly this data, or None
+        key = self.fingerprint(Data,p,q,method)
+        with closing(self.connect()) as con:
+            with con:
+                row = con.execute('SELECT opt_n, opt_lam, sigmasq FROM search WHERE key = ?',(key,)).fetchone()
+                if row is not None:
+                    con.execute('UPDATE search SET last_used = ? WHERE key = ?',(time.time(),key))
+        if row is None:
+            return None
+        return [int(row[0]),row[1],row[2]]
+    
+    def nearest(self,Data,p,q,method = 'GCV',max_change = 0.1):
+        ## Objective: Return the cached result of the longest earlier version of this series, or None
+        ##            An earlier version is a prefix of Data missing at most max_change of its points
+        ## Output:
+        ## 1: [opt_n,opt_lam,sigmasq,chain] of the earlier version, or None
+        
+        N = Data.shape[0]
+        first = int(ceil(N*(1-max_change)))
+        
+        ## An entry's head is the fingerprint of its first min(head,npts) points, so earlier versions shorter 
+        ## than head each have their own one
+        sizes = list(range(first,self.head if self.head < N else N))
+        if N-1 >= self.head and N-1 >= first:
+            sizes.append(self.head)
+        if len(sizes) == 0:
+            return None
+        heads = [self.fingerprint(Data[:m],p,q,method) for m in sizes]
+        
+        with closing(self.connect()) as con:
+            rows = con.execute('SELECT key, npts, opt_n, opt_lam, sigmasq, chain FROM search WHERE head IN (%s) AND npts < ? '
+                               'AND npts >= ? ORDER BY npts DESC' % ','.join(['?']*len(heads)),heads+[N,first]).fetchall()
+        for row in rows:
+            if row[0] == self.fingerprint(Data[:row[1]],p,q,method):
+                return [int(row[2]),row[3],row[4],int(row[5])]
+        return None
+    
+    def put(self,Data,p,q,result,method = 'GCV',chain = 0):
+        ## Objective: Store [opt_n,opt_lam,sigmasq] for the data and evict beyond max_entries
+        ##            chain: number of narrowed searches since the last full one (0 for a full search)
+        key = self.fingerprint(Data,p,q,method)
+        head = self.fingerprint(Data[:self.head],p,q,method)
+        with closing(self.connect()) as con:
+            with con:
+                con.execute('INSERT OR REPLACE INTO search (key, head, npts, opt_n, opt_lam, sigmasq, last_used, chain) '
+                            'VALUES (?,?,?,?,?,?,?,?)',
+                            (key,head,Data.shape[0],int(result[0]),float(result[1]),float(result[2]),time.time(),int(chain)))
+                con.execute('DELETE FROM search WHERE key IN (SELECT key FROM search ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                            (self.max_entries,))
+    
+    def clear(self):
+        ## Objective: Remove all entries
+        with closing(self.connect()) as con:
+            with con:
+                con.execute('DELETE FROM search')
+
+
+def Cached_search_nk(Data,p,q,cache,method = 'GCV',width = 2,max_change = 0.1,max_chain = 3):
+    ## Objective: full_search_nk backed by a Hyper_cache
+    ##            Exact matches are returned from the cache; for a series that only gained a few points since it was 
+    ##            cached, the search is narrowed to opt_n +/- width and started from the previous opt_lam
+    ##            A full search is done instead once max_chain narrowed searches followed each other, or when the 
+    ##            narrowed optimum lands on an edge of its range (the optimum may then have moved beyond it)
+    ## Input
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: p: degree of bases
+    ## 3: q: order of penalty
+    ## 4: cache: Hyper_cache instance
+    ## 5: method: model selection criterion, part of the cache key; only 'GCV' (what full_search_nk uses) is supported
+    ## 6: width: half width of the narrowed search over the number of sections
+    ## 7: max_change: largest fraction of new points for which the narrowed search is used
+    ## 8: max_chain: largest number of narrowed searches in a row
+    
+    ## Output
+    ## 1. Opt_n: Optimal number of sections
+    ## 2. Opt_lam: Corresponding optimal lambda
+    ## 3: sigmasq: Fitting Variance
+    
+    if method != 'GCV':
+        raise ValueError("full_search_nk only implements 'GCV', got %r" % (method,))
+    
+    res = cache.get(Data,p,q,method)
+    if res is not None:
+        return res
+    
+    chain = 0
+    prev = cache.nearest(Data,p,q,method,max_change)
+    if prev is not None and prev[3] < max_chain:
+        n_first = prev[0]-width if prev[0]-width > 1 else 1
+        n_last = prev[0]+width if prev[0]+width < Data.shape[0]-1 else Data.shape[0]-1
+        res = full_search_nk(Data,p,q,[n_first,n_last],prev[1])
+        chain = prev[3]+1
+        ## 1 and N-1 are the edges of the full search too
+        if (res[0] == n_first and n_first > 1) or (res[0] == n_last and n_last < Data.shape[0]-1):
+            res = None
+    
+    if res is None:
+        res = full_search_nk(Data,p,q)
+        chain = 0
+    
+    ## Same types as a cache hit
+    res = [int(res[0]),float(res[1]),float(res[2])]
+    cache.put(Data,p,q,res,method,chain)
+    return res
+
+
+###########################################################################################################################
+### State-space engine for knots at the data points (O(N q^2))
+### The random walk prior steps from one observation to the next with unit spacing, so the engine only accepts 
+### equally spaced data (checked by Smoother_ss); use the dense XZsigma / REML path for irregular series
+###########################################################################################################################
+
+def Band_ss(q,N,lamb):
+    ## Objective: Compute I + lamb*D'D in lower banded storage, D being the difference matrix of order q
+    ## Input
+    ## 1: q: order of penalty
+    ## 2: N: number of data points
+    ## 3: lamb: smoothing parameter
+    
+    ## Output
+    ## 1: ab: matrix (q+1 x N) with ab[k,i] = A[i+k,i]
+    
+    coef = diff(eye(q+1),q,axis = 0).flatten()
+    ab = zeros([q+1,N])
+    ab[0,:] = 1
+    for l1 in range(q+1):
+        for l2 in range(l1,q+1):
+            ab[l2-l1,l1:l1+N-q] += lamb*coef[l1]*coef[l2]
+    return ab
+
+
+def Smoother_ss(Data,q,lamb):
+    ## Objective: Compute the smoother with one coefficient per equally spaced data point (the limit c = N of the P-spline)
+    ##            A difference penalty of order q is an integrated random walk prior, and the banded Cholesky 
+    ##            solve below is the information form of the Kalman filter / RTS smoother with diffuse start
+    ## Input
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: q: order of penalty
+    ## 3: lamb: smoothing parameter
+    
+    ## Output
+    ## 1: f: smoothed values at the data points
+    ## 2: L: banded Cholesky factor of I + lamb*D'D (output of scipy.linalg.cholesky_banded)
+    
+    ## The transitions do not depend on the spacing, which is only right for equally spaced data
+    if not Is_uniform(Data[:,0]):
+        raise ValueError('Smoother_ss needs equally spaced data; use the XZsigma / REML path for irregular series')
+    
+    y = Data[:,1]
+    L = scipy.linalg.cholesky_banded(Band_ss(q,Data.shape[0],lamb),lower = True)
+    f = scipy.linalg.cho_solve_banded((L,True),y)
+    
+    ## For large lamb the solve loses digits in the smooth directions; the residual y - f - lamb*D'Df is still 
+    ## computed accurately (differences of neighbouring values are exact), so a few refinement steps recover them
+    for it in range(20):
+        r = diff(f,q)
+        for k in range(q):
+            r = concatenate([[-r[0]],-diff(r),[r[-1]]])
+        step = scipy.linalg.cho_solve_banded((L,True),y - f - lamb*r)
+        f = f + step
+        if abs(step).max() <= 1.0e-13*(abs(f).max()+1.0e-300):
+            break
+    return (f,L)
+
+
+def Band_inverse_diag(L):
+    ## Objective: Compute the diagonal of A^-1 from the banded Cholesky factor of A (Takahashi recursion), in O(N q^2)
+    ## Input
+    ## 1: L: banded Cholesky factor (lower storage, q+1 x N)
+    
+    ## Output
+    ## 1: d: diagonal of A^-1
+    
+    q = L.shape[0]-1
+    N = L.shape[1]
+    Lb = L.tolist()
+    S = [[0.0]*N for k in range(q+1)]     ## S[k][j] = inv(A)[j+k,j]
+    for j in range(N-1,-1,-1):
+        Ljj = Lb[0][j]
+        K = q if j+q < N else N-1-j
+        for i in range(j+K,j,-1):
+            t = 0.0
+            for k in range(j+1,j+K+1):
+                if i >= k:
+                    t += Lb[k-j][j]*S[i-k][k]
+                else:
+                    t += Lb[k-j][j]*S[k-i][i]
+            S[i-j][j] = -t/Ljj
+        t = 0.0
+        for k in range(j+1,j+K+1):
+            t += Lb[k-j][j]*S[k-j][j]
+        S[0][j] = 1/Ljj**2 - t/Ljj
+    return array(S[0])
+
+
+def Deviance_ss(Data,q,lamb):
+    ## Objective: Compute the penalized residual sum of squares and log determinant needed by the REML metric
+    ## Input:
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: q: order of penalty
+    ## 3: lamb: smoothing parameter
+    
+    ## Output:
+    ## 1: Dp: |y-f|^2 + lamb*|D f|^2 at the smoother f
+    ## 2: logdet: log determinant of I + lamb*D'D
+    ## (both inf if lamb is too large for the banded factorization)
+    
+    try:
+        f,L = Smoother_ss(Data,q,lamb)
+    except linalg.LinAlgError:
+        return (inf,inf)
+    Dp = sum((Data[:,1]-f)**2) + lamb*sum(diff(f,q)**2)
+    logdet = 2*sum(log(L[0,:]))
+    return (Dp,logdet)
+
+
+def REML_ss(par,Data,q):
+    ## Objective: Compute the REML metric of the state-space (knots at data points) model in O(N q^2)
+    ## Input:
+    ## 1: par: parameter values for lambda and error variance
+    ## 2: Data: dataset with dimensions: number of points x 2
+    ## 3: q: order of penalty
+    
+    ## Output:
+    ## 1: reml: value of the metric (negative restricted log likelihood, up to a constant not depending on par)
+    
+    lamb = par[0]
+    sig = par[1]
+    N = Data.shape[0]
+    Dp,logdet = Deviance_ss(Data,q,lamb)
+    reml = 0.5*(Dp/sig + (N-q)*log(2*pi*sig) + logdet - (N-q)*log(lamb))
+    return reml
+
+
+def max_reml_ss(Data,q):
+    ## Objective: compute the parameters that give maximized REML with the state-space engine
+    ##            The variance is profiled out (sig = Dp/(N-q)), leaving a bounded one dimensional search over log(lambda)
+    ##            The upper bound on lambda grows with N and stops where the banded solve can no longer be refined
+    ## Input:
+    ## 1: Data: dataset with dimensions: number of points x 2, equally spaced
+    ## 2: q: order of penalty
+    
+    ## Output:
+    ## 1: lam: optimal lambda
+    ## 2: sig: Optimal variance 
+    
+    N = Data.shape[0]
+    
+    def profile(loglam):
+        lamb = exp(loglam)
+        Dp,logdet = Deviance_ss(Data,q,lamb)
+        if not isfinite(Dp):
+            return inf
+        sig = Dp/(N-q)
+        return 0.5*(Dp/sig + (N-q)*log(2*pi*sig) + logdet - (N-q)*log(lamb))
+    
+    ## Search range: lamb*h^(2q), h = 1/N, up to 1e6, but not past the point where refinement in 
+    ## Smoother_ss stops converging (lamb*|coef|^2 of the order of 1/eps)
+    coef = diff(eye(q+1),q,axis = 0).flatten()
+    lam_max = 0.5/(finfo(float).eps*sum(coef**2))
+    if 1.0e+6*float(N)**(2*q) < lam_max:
+        lam_max = 1.0e+6*float(N)**(2*q)
+    opt_par = minimize_scalar(profile,bounds = (log(1.0e-2),log(lam_max)),method = 'bounded',options = {'xatol': 1.0e-3})
+    lam = exp(opt_par.x)
+    sig = Deviance_ss(Data,q,lam)[0]/(N-q)
+    return [lam,sig]
+
+
+def Inference_ss(Data,q,lamb,sig,confidence = 0.95):
+    ## Objective: Compute the mean prediction and confidence intervals at the data points with the state-space engine
+    ##            The engine has one coefficient per data point and no basis to evaluate elsewhere, so results exist 
+    ##            only at Data[:,0]; predictions on another grid (e.g. xpred) need the dense Basis_Pspline path
+    ## Input
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: q: order of penalty
+    ## 3: lamb: lambda value
+    ## 4: sig: variance
+    ## 5: confidence: percentage
+    
+    ## Output:
+    ## 1: f: Mean prediction at the data points
+    ## 2: stdev_t: t-CI, with residual degrees of freedom N - trace(S) rather than the N - 2trace(S) + trace(SS') 
+    ##             used by Var_bounds and Inference (trace(SS') needs the full inverse); the t quantiles of the two 
+    ##             engines therefore differ slightly for short series
+    ## 3: stdev_n: Normal CI (identical definition to Inference)
+    
+    f,L = Smoother_ss(Data,q,lamb)
+    d = Band_inverse_diag(L)
+    
+    df_res = Data.shape[0] - sum(d)
+    se = sqrt(sig*d)
+    stdev_t = scipy.stats.t.ppf((1+confidence)/2.,df_res)*se
+    stdev_n = scipy.stats.norm.ppf((1+confidence)/2.)*se
+    return(f,stdev_t,stdev_n)
+
+
+###########################################################################################################################
+### Exact roots, extrema and inflection points from the spline coefficients
+###########################################################################################################################
+
+def Pspline_ppoly(theta,p,U,n,k = 0):
+    ## Objective: Convert the fitted spline (or its kth derivative) to polynomial form on each knot span of [U[p],U[n+p]]
+    ## Input
+    ## 1: theta: coordinate of projection on the bases (c,)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    ## 5: k: order of the derivative
+    
+    ## Output
+    ## 1: pp: scipy.interpolate.PPoly with one polynomial piece per knot span
+    
+    spl = scipy.interpolate.BSpline(U,asarray(theta,dtype = float).flatten(),p)
+    if k > 0:
+        spl = spl.derivative(k)
+    pp = scipy.interpolate.PPoly.from_spline(spl)
+    
+    ## Keep the spans inside [U[p],U[n+p]] (the knots outside only support the boundary basis functions)
+    first = searchsorted(pp.x,U[p])
+    last = searchsorted(pp.x,U[n+p])
+    pp = scipy.interpolate.PPoly(pp.c[:,first:last],pp.x[first:last+1],extrapolate = False)
+    return pp
+
+
+def Roots_Pspline(theta,p,U,n,k = 0,value = 0.0):
+    ## Objective: Compute all locations where the fitted spline (or its kth derivative) equals value
+    ## Input
+    ## 1: theta: coordinate of projection on the bases, (c,) for one series or (c x number of series)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    ## 5: k: order of the derivative
+    ## 6: value: level to cross, 0 for the zero crossings
+    
+    ## Output
+    ## 1: sorted array of isolated locations (a list of arrays, one per series, if theta has several columns)
+    ##    Knot spans on which the curve equals value identically are intervals rather than roots and are excluded, 
+    ##    including their end points; Flat_spans_Pspline returns them
+    
+    theta = asarray(theta,dtype = float)
+    if theta.ndim == 2 and theta.shape[1] > 1:
+        return [Roots_Pspline(theta[:,s],p,U,n,k,value) for s in range(theta.shape[1])]
+    
+    pp = Pspline_ppoly(theta,p,U,n,k)
+    r = pp.solve(value,discontinuity = False,extrapolate = False)
+    r = unique(r[~isnan(r)])
+    
+    flat = Flat_spans_Pspline(theta,p,U,n,k,value)
+    for (lo,hi) in flat:
+        r = r[(r < lo) | (r > hi)]
+    
+    ## A root on a knot is found from the spans on both sides
+    tol = 1.0e-10*(U[n+p]-U[p])
+    if len(r) > 1:
+        r = r[concatenate([[True],diff(r) > tol])]
+    return r
+
+
+def Flat_spans_Pspline(theta,p,U,n,k = 0,value = 0.0):
+    ## Objective: Compute the knot spans on which the fitted spline (or its kth derivative) is identically equal to value
+    ## Input
+    ## 1: theta: coordinate of projection on the bases (c,)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    ## 5: k: order of the derivative
+    ## 6: value: level
+    
+    ## Output
+    ## 1: intervals: array with rows [start, end], adjacent flat spans merged
+    
+    theta = asarray(theta,dtype = float).flatten()
+    pp = Pspline_ppoly(theta,p,U,n,k)
+    h = diff(pp.x)
+    cc = pp.c.copy()
+    cc[-1,:] = cc[-1,:] - value
+    
+    ## Contribution of each power over its span, against the size of the curve on that span
+    deg = cc.shape[0]-1
+    contrib = abs(cc)*h[newaxis,:]**arange(deg,-1,-1)[:,newaxis]
+    scale = abs(theta).max()/h**k + abs(value)
+    flat = all(contrib <= 1.0e-10*scale[newaxis,:],axis = 0)
+    
+    intervals = []
+    for i in range(len(h)):
+        if flat[i]:
+            if len(intervals) > 0 and intervals[-1][1] == pp.x[i]:
+                intervals[-1][1] = pp.x[i+1]
+            else:
+                intervals.append([pp.x[i],pp.x[i+1]])
+    return array(intervals).reshape(-1,2)
+
+
+def Turning_points(theta,p,U,n,k):
+    ## Objective: Compute the roots of the kth derivative at which it changes sign
+    ## Input
+    ## 1: theta: coordinate of projection on the bases (c,)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    ## 5: k: order of the derivative (1: extrema, 2: inflection points)
+    
+    ## Output
+    ## 1: x: locations of the roots
+    ## 2: left, right: sign of the kth derivative just before and just after each root
+    
+    x = Roots_Pspline(theta,p,U,n,k)
+    pp = Pspline_ppoly(theta,p,U,n,k)
+    delta = 1.0e-7*(U[n+p]-U[p])
+    left = sign(pp(clip(x-delta,U[p],U[n+p])))
+    right = sign(pp(clip(x+delta,U[p],U[n+p])))
+    return (x,left,right)
+
+
+def Extrema_Pspline(theta,p,U,n):
+    ## Objective: Compute the exact locations and values of the local maxima and minima of the fitted spline
+    ## Input
+    ## 1: theta: coordinate of projection on the bases, (c,) for one series or (c x number of series)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    
+    ## Output
+    ## 1: maxima: array with rows [location, value]
+    ## 2: minima: array with rows [location, value]
+    ## (lists of these, one per series, if theta has several columns)
+    
+    theta = asarray(theta,dtype = float)
+    if theta.ndim == 2 and theta.shape[1] > 1:
+        out = [Extrema_Pspline(theta[:,s],p,U,n) for s in range(theta.shape[1])]
+        return ([o[0] for o in out],[o[1] for o in out])
+    
+    x,left,right = Turning_points(theta,p,U,n,1)
+    f = Pspline_ppoly(theta,p,U,n)
+    xmax = x[(left > 0) & (right < 0)]
+    xmin = x[(left < 0) & (right > 0)]
+    maxima = column_stack([xmax,f(xmax)])
+    minima = column_stack([xmin,f(xmin)])
+    return (maxima,minima)
+
+
+def Inflection_Pspline(theta,p,U,n):
+    ## Objective: Compute the exact locations and values of the inflection points of the fitted spline
+    ## Input
+    ## 1: theta: coordinate of projection on the bases, (c,) for one series or (c x number of series)
+    ## 2: p: degree (at least 3 for a continuous second derivative)
+    ## 3: U: Knot vector
+    ## 4: n: number of sections on the curve
+    
+    ## Output
+    ## 1: point: array with rows [location, value] (a list of these, one per series, if theta has several columns)
+    
+    theta = asarray(theta,dtype = float)
+    if theta.ndim == 2 and theta.shape[1] > 1:
+        return [Inflection_Pspline(theta[:,s],p,U,n) for s in range(theta.shape[1])]
+    
+    x,left,right = Turning_points(theta,p,U,n,2)
+    f = Pspline_ppoly(theta,p,U,n)
+    xinf = x[left*right < 0]
+    point = column_stack([xinf,f(xinf)])
+    return point
+
+
+###########################################################################################################################
+### Exact integrals and interval aggregates
+###########################################################################################################################
+
+def Integral_Pspline(theta,p,U,a,b):
+    ## Objective: Compute the exact definite integrals of the fitted spline over many intervals
+    ##            from the antiderivative spline (degree p+1), O(p) per interval
+    ## Input
+    ## 1: theta: coordinate of projection on the bases, (c,) for one series or (c x number of series)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: a: interval starts (num,)
+    ## 5: b: interval ends (num,)
+    
+    ## Output
+    ## 1: I: integrals (num,), or (num x number of series)
+    
+    theta = asarray(theta,dtype = float)
+    if theta.ndim == 2 and theta.shape[1] == 1:
+        theta = theta.flatten()
+    F = scipy.interpolate.BSpline(U,theta,p).antiderivative()
+    I = F(asarray(b,dtype = float)) - F(asarray(a,dtype = float))
+    return I
+
+
+def Interval_mean(theta,p,U,a,b):
+    ## Objective: Compute the exact mean of the fitted spline over many intervals
+    ## Input
+    ## 1: theta: coordinate of projection on the bases, (c,) for one series or (c x number of series)
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: a: interval starts (num,)
+    ## 5: b: interval ends (num,)
+    
+    ## Output
+    ## 1: interval means (num,), or (num x number of series); for a zero length interval (a == b) the mean is 
+    ##    the limit, i.e. the value of the spline at a
+    
+    a,b = broadcast_arrays(asarray(a,dtype = float),asarray(b,dtype = float))
+    I = Integral_Pspline(theta,p,U,a,b)
+    width = b-a
+    zero = width == 0
+    width = where(zero,1.0,width)
+    if I.ndim > a.ndim:
+        width = width[...,newaxis]
+    M = array(I/width)
+    if any(zero):
+        theta = asarray(theta,dtype = float)
+        if theta.ndim == 2 and theta.shape[1] == 1:
+            theta = theta.flatten()
+        M[zero] = scipy.interpolate.BSpline(U,theta,p)(a[zero])
+    ## A scalar for scalar a and b, as Integral_Pspline
+    return M[()]
+
+
+def Integral_weights(p,U,a,b):
+    ## Objective: Compute the integrals of every basis function over each interval, so that the integral of the 
+    ##            fitted spline is W.dot(theta)
+    ## Input
+    ## 1: p: degree
+    ## 2: U: Knot vector
+    ## 3: a: interval starts (num,)
+    ## 4: b: interval ends (num,)
+    
+    ## Output
+    ## 1: W: matrix (num x c)
+    
+    c = len(U)-p-1
+    F = scipy.interpolate.BSpline(U,eye(c),p).antiderivative()
+    W = F(asarray(b,dtype = float)) - F(asarray(a,dtype = float))
+    return W
+
+
+def Integral_var(Data,B_dat,theta,P,lamb,p,U,a,b):
+    ## Objective: Compute the integrals of the fitted spline over many intervals together with their variances
+    ## Input:
+    ## 1: Data: dataset with dimensions: number of points x 2
+    ## 2: B_dat: bases matrix at data locations
+    ## 3: theta: coordinate of projection on the bases
+    ## 4: P: Penalty matrix
+    ## 5: lamb: Optimal lambda computed
+    ## 6: p: degree
+    ## 7: U: Knot vector
+    ## 8: a: interval starts (num,)
+    ## 9: b: interval ends (num,)
+    
+    ## Output
+    ## 1: I: integrals (num,)
+    ## 2: var: variance of each integral (num,), same error model as Var_bounds
+    
+    P = lamb*P
+    Ainv = inv(B_dat.T.dot(B_dat) + P)
+    nr = (Data[:,1].reshape(-1,1) - B_dat.dot(theta.reshape(-1,1))).reshape(-1,1)
+    term = B_dat.dot(Ainv.dot(B_dat.T))
+    
+    n = Data.shape[0]
+    df_res = n - 2*trace(term) + trace(term.dot(term.T))
+    sigmasq = (nr.T.dot(nr))/(df_res)
+    sigmasq = sigmasq[0][0]
+    
+    W = Integral_weights(p,U,a,b)
+    I = W.dot(theta.reshape(-1,1)).flatten()
+    var = sigmasq*sum(W.dot(Ainv)*W,axis = 1)
+    return (I,var)
+
+
 ###########################################################################################################################
 ###########################################################################################################################
     
\ No newline at end of file
@@ -0,0 +1,314 @@
+#############################################################################################################################
+##################################### ALPS python code                                       ################################
+#############################################################################################################################
+
+##### This File contains an asyncio prediction service over fitted ALPS models
+#### Fitted models are held in memory and concurrent requests for the same model that arrive within a short window
+#### are coalesced into one vectorized evaluation, run in a thread pool
+
+## 1: Fitted_model(n,p,U,theta,Data,B_dat,P,lamb,confidence = 0.95)
+## 2: Prediction_server(window = 0.002,max_batch = 4096,workers = 4)
+## 3: Local_client(server)
+## 4: Fail_future(fut,err)
+## 5: Call_in_loop(loop,func,*args)
+
+#############################################################################################################################
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Functions import *
+
+
+class Fitted_model:
+    ## Objective: Hold a fitted P-spline with everything needed for predictions and bands precomputed
+    ## Input:
+    ## 1: n: number of sections on the curve
+    ## 2: p: degree
+    ## 3: U: Knot vector
+    ## 4: theta: coordinate of projection on the bases
+    ## 5: Data: dataset with dimensions: number of points x 2
+    ## 6: B_dat: bases matrix at data locations
+    ## 7: P: Penalty matrix
+    ## 8: lamb: Optimal lambda computed
+    ## 9: confidence: defaults to 95% if no value provided
+
+    def __init__(self,n,p,U,theta,Data,B_dat,P,lamb,confidence = 0.95):
+        self.n = n
+        self.p = p
+        self.U = U
+        self.theta = theta.reshape(-1,1)
+
+        ## Same variance computation as Var_bounds, done once instead of per request
+        Ainv = inv(B_dat.T.dot(B_dat) + lamb*P)
+        nr = Data[:,1].reshape(-1,1) - B_dat.dot(self.theta)
+        term = B_dat.dot(Ainv).dot(B_dat.T)
+        df_res = Data.shape[0] - 2*trace(term) + trace(term.dot(term.T))
+        sigmasq = (nr.T.dot(nr))[0][0]/df_res
+        self.cov = sigmasq*Ainv
+        self.t_fac = scipy.stats.t.ppf((1+confidence)/2.,df_res)
+        self.n_fac = scipy.stats.norm.ppf((1+confidence)/2.)
+
+    def evaluate(self,loc,derivative = False,bounds = True):
+        ## Objective: Compute the prediction (or first derivative) and its bounds at the given locations
+        ## Input:
+        ## 1: loc: the locations at which we want predictions
+        ## 2: derivative: evaluate the first derivative instead of the curve
+        ## 3: bounds: also compute the t and normal bounds
+
+        ## Output:
+        ## 1: f: prediction
+        ## 2: stdev_t: t-distribution bound (None if bounds is False)
+        ## 3: stdev_n: normal bound (None if bounds is False)
+
+        B = self.basis(loc,derivative)
+        f = B.dot(self.theta).flatten()
+        if not bounds:
+            return (f,None,None)
+        std = sqrt(asarray(B.multiply(B.dot(self.cov)).sum(axis = 1)).flatten())
+        return (f,self.t_fac*std,self.n_fac*std)
+
+    def basis(self,loc,derivative = False):
+        ## Objective: Compute the sparse bases (or first derivative bases) matrix for a whole batch at once
+        ##            Same values as Basis_Pspline / Basis_derv_Pspline, without the per element recursion
+        ## Input:
+        ## 1: loc: the locations at which we want basis functions to be evaluated
+        ## 2: derivative: first derivative bases instead of the bases
+
+        ## Output:
+        ## 1: B: sparse matrix (number of locations x n+p)
+
+        U = self.U
+        p = self.p
+        c = self.n+p
+        loc = asarray(loc,dtype = float)
+        if not derivative:
+            return scipy.interpolate.BSpline.design_matrix(loc,U,p,extrapolate = True).tocsr()
+
+        ## dN_i,p = p*(N_i,p-1/(U[i+p]-U[i]) - N_i+1,p-1/(U[i+p+1]-U[i+1]))
+        M = scipy.interpolate.BSpline.design_matrix(loc,U,p-1,extrapolate = True).tocsc()
+        w = p/(U[p:p+c+1]-U[:c+1])
+        M = M.multiply(w[newaxis,:]).tocsc()
+        return (M[:,:c] - M[:,1:c+1]).tocsr()
+
+
+class Prediction_server:
+    ## Objective: Serve predictions, bounds and derivatives of registered models, batching concurrent requests
+    ## Input:
+    ## 1: window: time in seconds a request waits for others to the same model before evaluation
+    ## 2: max_batch: number of locations after which a batch is evaluated without waiting for the window
+    ## 3: workers: number of threads doing the numeric work
+
+    def __init__(self,window = 0.002,max_batch = 4096,workers = 4):
+        self.window = window
+        self.max_batch = max_batch
+        self.models = {}
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+        self.closed = False
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.latencies = deque(maxlen = 10000)
+        self.counts = {'requests': 0, 'batches': 0, 'points': 0, 'errors': 0}
+
+        ## Requests may come from several event loops (e.g. Local_client's background loop), each in its own 
+        ## thread, so all shared state is only touched while holding this lock
+        self.lock = threading.Lock()
+
+    def register(self,name,model):
+        ## Objective: Add or replace a fitted model under the given name
+        with self.lock:
+            self.models[name] = model
+
+    def unregister(self,name):
+        ## Objective: Remove a fitted model
+        with self.lock:
+            self.models.pop(name,None)
+
+    async def predict(self,name,loc,derivative = False,bounds = False):
+        ## Objective: Request the prediction of a registered model at given locations
+        ## Input:
+        ## 1: name: registered model name
+        ## 2: loc: the locations at which we want predictions
+        ## 3: derivative: evaluate the first derivative instead of the curve
+        ## 4: bounds: also return the t and normal bounds
+
+        ## Output:
+        ## 1: f if bounds is False, otherwise (f,stdev_t,stdev_n)
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        ## Requests are batched per event loop, as a future can only be completed by its own loop
+        key = (loop,name,derivative)
+        loc = asarray(loc,dtype = float).flatten()
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('server closed')
+            if name not in self.models:
+                raise KeyError(name)
+            queue = self.pending.setdefault(key,[])
+            queue.append((loc,bounds,fut,time.perf_counter()))
+            self.counts['requests'] += 1
+            full = sum([len(r[0]) for r in queue]) >= self.max_batch
+            if not full and key not in self.timers:
+                self.timers[key] = loop.call_later(self.window,self._flush,key)
+
+        if full:
+            self._flush(key)
+        return await fut
+
+    def _flush(self,key):
+        ## Runs on the loop of key[0], which also owns the timer
+        with self.lock:
+            timer = self.timers.pop(key,None)
+            batch = self.pending.pop(key,[])
+        if timer is not None:
+            timer.cancel()
+        if len(batch) > 0:
+            task = asyncio.ensure_future(self._run(key,batch))
+            with self.lock:
+                self.tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self,task):
+        with self.lock:
+            self.tasks.discard(task)
+
+    async def _run(self,key,batch):
+        loop,name,derivative = key
+        loc = concatenate([r[0] for r in batch])
+        need_bounds = any([r[1] for r in batch])
+        try:
+            with self.lock:
+                model = self.models[name]
+            f,stdev_t,stdev_n = await loop.run_in_executor(self.pool,model.evaluate,loc,derivative,need_bounds)
+        except Exception as err:
+            with self.lock:
+                self.counts['errors'] += 1
+            for r in batch:
+                Fail_future(r[2],err)
+            return
+
+        now = time.perf_counter()
+        start = 0
+        for (l,bounds,fut,t0) in batch:
+            end = start+len(l)
+            if not fut.done():
+                if bounds:
+                    fut.set_result((f[start:end],stdev_t[start:end],stdev_n[start:end]))
+                else:
+                    fut.set_result(f[start:end])
+            start = end
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['points'] += len(loc)
+            self.latencies.extend([now-r[3] for r in batch])
+
+    def metrics(self):
+        ## Objective: Report latency and queue metrics
+        ## Output:
+        ## 1: dictionary with request/batch counts, mean batch size, queued requests and latency percentiles (seconds)
+
+        with self.lock:
+            out = dict(self.counts)
+            queued = sum([len(v) for v in self.pending.values()])
+            nmodels = len(self.models)
+            lat = array(list(self.latencies))
+        out['mean_batch_requests'] = out['requests']/out['batches'] if out['batches'] > 0 else 0.0
+        out['queued_requests'] = int(queued)
+        out['models'] = nmodels
+        if len(lat) > 0:
+            out['latency_mean'] = mean(lat)
+            out['latency_p50'] = percentile(lat,50)
+            out['latency_p95'] = percentile(lat,95)
+            out['latency_max'] = lat.max()
+        return out
+
+    def close(self):
+        ## Objective: Fail every queued request with RuntimeError('server closed') and stop the worker threads
+        ##            Batches already being evaluated are completed normally; may be called from any thread
+        with self.lock:
+            self.closed = True
+            timers = self.timers
+            pending = self.pending
+            self.timers = {}
+            self.pending = {}
+        for key,timer in timers.items():
+            Call_in_loop(key[0],timer.cancel)
+        for key,batch in pending.items():
+            for r in batch:
+                Call_in_loop(key[0],Fail_future,r[2],RuntimeError('server closed'))
+        self.pool.shutdown(wait = True)
+
+
+def Fail_future(fut,err):
+    ## Objective: Set an exception on a future unless it is already done
+    if not fut.done():
+        fut.set_exception(err)
+
+
+def Call_in_loop(loop,func,*args):
+    ## Objective: Run func(*args) on the thread owning loop (directly if that is the calling thread)
+    if loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func,*args)
+
+
+class Local_client:
+    ## Objective: In-process client for a Prediction_server
+    ##            Async code (including a running notebook loop) awaits predict / predict_many_async; plain 
+    ##            synchronous calls to predict_many run on the client's own event loop in a background thread, 
+    ##            so they also work from inside a running event loop such as Jupyter's
+    ## Input:
+    ## 1: server: Prediction_server instance
+
+    def __init__(self,server):
+        self.server = server
+        self.loop = None
+        self.thread = None
+
+    async def predict(self,name,loc,derivative = False,bounds = False):
+        return await self.server.predict(name,loc,derivative,bounds)
+
+    async def predict_many_async(self,requests):
+        ## Objective: Issue many requests concurrently on the calling event loop and wait for all of them
+        ## Input:
+        ## 1: requests: list of (name,loc) or (name,loc,derivative,bounds)
+
+        ## Output:
+        ## 1: list of responses in the order of the requests
+
+        return await asyncio.gather(*[self.server.predict(*r) for r in requests])
+
+    def predict_many(self,requests):
+        ## Objective: Blocking version of predict_many_async, run on the client's background event loop
+        ## Input:
+        ## 1: requests: list of (name,loc) or (name,loc,derivative,bounds)
+
+        ## Output:
+        ## 1: list of responses in the order of the requests
+
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target = self.loop.run_forever,daemon = True)
+            self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.predict_many_async(requests),self.loop).result()
+
+    def close(self):
+        ## Objective: Stop the background event loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None